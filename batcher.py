@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+from imaging import OUTPUT_MODE
+
+BATCH_WINDOW_MS = int(os.environ.get("BATCH_WINDOW_MS", "20"))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "8"))
+
+
+class MicroBatcher:
+    """Collects the photos that arrive within a short window (or until the
+    batch is full) and sends them to the inference executor as one job."""
+
+    def __init__(self, inference, window=BATCH_WINDOW_MS / 1000, max_size=BATCH_SIZE,
+                 output=OUTPUT_MODE, load=None):
+        self.inference = inference
+        self.output = output
+        # returns the current queue load, the output encoder adapts to it
+        self.load = load or (lambda: 0.0)
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+
+    async def submit(self, image_bytes, mask=None, model=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(model, [])
+        batch.append(((image_bytes, mask), future))
+
+        if len(batch) >= self.max_size:
+            self.flush(model)
+        elif len(batch) == 1:
+            self.timers[model] = loop.call_later(self.window, self.flush, model)
+
+        return await future
+
+    async def submit_all(self, jobs, model=None):
+        """Submit (image_bytes, mask) jobs that are all at hand as batches of
+        their own, run right away instead of after the window. Returns the
+        result, or the exception, of every job."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for start in range(0, len(jobs), self.max_size):
+            # not through self.pending, which may hold single jobs already
+            batch = [(job, loop.create_future()) for job in jobs[start:start + self.max_size]]
+            futures += [future for _, future in batch]
+            self.start(model, batch)
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def flush(self, model):
+        batch = self.pending.pop(model, [])
+        timer = self.timers.pop(model, None)
+        if timer:
+            timer.cancel()
+        if batch:
+            self.start(model, batch)
+
+    def start(self, model, batch):
+        # keep a reference so the task isn't garbage collected while running
+        task = asyncio.ensure_future(self.run(model, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, model, batch):
+        try:
+            results = await self.inference.remove_background_batch(
+                [job for job, _ in batch], model, self.output, self.load()
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
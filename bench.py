@@ -0,0 +1,286 @@
+"""Replays a directory of images (and/or generated ones) through bot.py's own
+process and send_result, download -> decode -> segment -> encode -> reply,
+with a stub client in place of Telegram, and prints the results as JSON.
+
+    python bench.py [images_dir] [--synthetic 20] [--concurrency 8] [--output run.json] [--baseline old.json]
+    python bench.py --synthetic 20 --compare-output-modes
+    python bench.py --synthetic 6 --compare-matting
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from pathlib import Path
+
+# the bot is set up with a fake account and without the on-disk caches
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "0" * 32)
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("RESULT_CACHE_PATH", ":memory:")
+
+import numpy as np
+from PIL import Image, ImageDraw
+from pyrogram.file_id import FileId, FileType
+
+from imaging import OUTPUT_MODE, OUTPUT_MODES, open_image
+from inference import segment_batch
+from jobqueue import percentile
+from matting import cutout
+from metrics import Metrics, RATIO_BUCKETS
+from sessions import SessionPool
+
+SYNTHETIC_SIZES = [(640, 480), (1280, 960), (2560, 1920)]
+
+
+def synthetic_image(width, height, seed):
+    """A noisy gradient background with a few solid shapes in front, as JPEG."""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    background = gradient + rng.normal(0, 25, (height, width, 3))
+    image = Image.fromarray(np.clip(background, 0, 255).astype(np.uint8), "RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(3):
+        x, y = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        draw.ellipse([x, y, x + width // 3, y + height // 3], fill=color)
+    with io.BytesIO() as f:
+        image.save(f, format="jpeg", quality=90)
+        return f.getvalue()
+
+
+class StubMedia:
+    def __init__(self, n, data):
+        self.file_id = FileId(file_type=FileType.DOCUMENT, dc_id=1, media_id=n, access_hash=0).encode()
+        self.file_unique_id = str(n)
+        self.file_size = len(data)
+        self.data = data
+
+
+class StubClient:
+    """Serves downloads from memory in the same 1 MiB chunks as Client.get_file."""
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, media):
+        self.media = {m.file_id: m for m in media}
+
+    async def get_file(self, file_id, file_size=0, limit=0, offset=0, progress=None, progress_args=()):
+        data = self.media[file_id.encode()].data
+        for i in range(0, len(data), self.chunk_size):
+            await asyncio.sleep(0)
+            yield data[i:i + self.chunk_size]
+
+
+class StubMessage:
+    """The message a photo came in, takes the reply bot.send_result sends."""
+
+    def __init__(self, n, stages):
+        self.n = n
+        self.stages = stages
+
+    async def reply_photo(self, f):
+        # what save_file does with the upload: read it in 512 KB parts
+        size = 0
+        while part := f.read(512 * 1024):
+            size += len(part)
+            await asyncio.sleep(0)
+        self.stages["output_bytes"].append(size)
+        file = type("StubFile", (), {"file_id": str(self.n)})()
+        return type("StubSent", (), {"photo": file, "sticker": None, "document": None})()
+
+    async def reply_sticker(self, f):
+        return await self.reply_photo(f)
+
+    async def reply_document(self, f, force_document=False):
+        return await self.reply_photo(f)
+
+
+class StageMetrics(Metrics):
+    """The bot's metrics, also keeping every value for the percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.histogram("compression_ratio", RATIO_BUCKETS)
+        self.values = defaultdict(list)
+
+    def record(self, name, value, **labels):
+        super().record(name, value, **labels)
+        self.values[name].append(value)
+
+    def observe(self, stage, seconds, **labels):
+        super().observe(stage, seconds, **labels)
+        self.values[stage].append(seconds)
+
+
+async def run(bot, images, concurrency, reuse_masks, output_mode=OUTPUT_MODE):
+    """Runs the images through bot.process and bot.send_result, bot.setup()
+    has to be called before and the coroutine run on bot.app.loop."""
+    media = [StubMedia(n, data) for n, data in enumerate(images)]
+    bot.app.get_file = StubClient(media).get_file
+    bot.batcher.output = output_mode
+    if not reuse_masks:
+        bot.masks.threshold = -1
+    bot.jobs.concurrency = concurrency
+    bot.jobs.depth = max(bot.jobs.depth, concurrency)
+    bot.metrics = StageMetrics()
+    stages = bot.metrics.values
+    slots = asyncio.Semaphore(concurrency)
+    inference = bot.inference
+
+    # start every worker and load the models before timing anything
+    await inference.warm_up()
+
+    async def job(m):
+        async with slots:
+            # every photo from its own user, the per user limit stays out of the way
+            message = StubMessage(m.file_unique_id, stages)
+            data, name, labels = await bot.process(message, m, m.file_unique_id)
+            await bot.send_result(message, m, data, name, labels)
+
+    # the workers report their own CPU time, os.times() only counts them
+    # once they have exited, warm-up included
+    worker_cpu = inference.cpu_time()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    await asyncio.gather(*[job(m) for m in media])
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu + inference.cpu_time() - worker_cpu
+    # the workers have to exit before their memory is counted
+    inference.shutdown()
+
+    return {
+        "images": len(images),
+        "concurrency": concurrency,
+        "output_mode": output_mode,
+        "workers": inference.workers,
+        "seconds": wall,
+        "images_per_sec": len(images) / wall,
+        "cpu_utilisation": cpu / wall / (os.cpu_count() or 1),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "stages": {
+            stage: {
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "mean": sum(values) / len(values),
+            }
+            for stage, values in stages.items()
+        },
+    }
+
+
+def compare_matting(images, modes=("full", "band", "pyramid")):
+    """Time every matting mode on the same masks and measure how far its
+    alpha is from the whole image closed-form solve."""
+    sessions = SessionPool()
+    times = defaultdict(list)
+    errors = defaultdict(list)
+    for image_bytes in images:
+        with sessions.session() as session:
+            mask = segment_batch(session, [image_bytes])[0]
+        image = open_image(image_bytes)
+        mask = mask.resize(image.size, Image.BILINEAR)
+        alphas = {}
+        for mode in modes:
+            start = time.perf_counter()
+            alphas[mode] = np.asarray(cutout(image, mask, mode))[..., 3].astype(np.float32) / 255
+            times[mode].append(time.perf_counter() - start)
+        for mode in modes:
+            diff = np.abs(alphas[mode] - alphas[modes[0]])
+            errors[mode].append((float(diff.mean()), float((diff > 0.1).mean())))
+
+    return {
+        mode: {
+            "seconds_p50": percentile(times[mode], 50),
+            "seconds_mean": sum(times[mode]) / len(times[mode]),
+            # against the first mode, the full solve
+            "mean_abs_error": sum(e for e, _ in errors[mode]) / len(errors[mode]),
+            "pixels_off_by_10_percent": sum(p for _, p in errors[mode]) / len(errors[mode]),
+        }
+        for mode in modes
+    }
+
+
+def compare(result, baseline):
+    lines = [f"images/sec: {baseline['images_per_sec']:.2f} -> {result['images_per_sec']:.2f}"]
+    for stage, values in result["stages"].items():
+        if stage in baseline["stages"]:
+            lines.append(f"{stage} p50: {baseline['stages'][stage]['p50']:.4f} -> {values['p50']:.4f}")
+    return "\n".join(lines)
+
+
+def compare_output_modes(results):
+    """Encode time against bytes uploaded for every output mode."""
+    lines = []
+    for result in results:
+        encode = result["stages"]["encode"]
+        size = result["stages"]["output_bytes"]
+        lines.append(
+            f"{result['output_mode']}: encode p50 {encode['p50']:.4f}s p95 {encode['p95']:.4f}s, "
+            f"{size['mean'] / 1024:.0f} KiB on average, upload p50 {result['stages']['upload']['p50']:.4f}s"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images_dir", nargs="?", help="directory of images to replay")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of generated images to add")
+    parser.add_argument("--repeat", type=int, default=1, help="times every image is sent")
+    parser.add_argument("--concurrency", type=int, default=8, help="photos in flight at once")
+    parser.add_argument("--reuse-masks", action="store_true", help="enable the perceptual hash mask reuse")
+    parser.add_argument("--output-mode", choices=OUTPUT_MODES, default=OUTPUT_MODE, help="how results are encoded")
+    parser.add_argument("--compare-output-modes", action="store_true", help="run once per output mode and compare them")
+    parser.add_argument("--compare-matting", action="store_true", help="compare time and quality of the matting modes")
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--baseline", help="JSON result of an earlier run to compare with")
+    args = parser.parse_args()
+
+    images = []
+    if args.images_dir:
+        for path in sorted(Path(args.images_dir).iterdir()):
+            if path.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"):
+                images.append(path.read_bytes())
+    for n in range(args.synthetic):
+        images.append(synthetic_image(*SYNTHETIC_SIZES[n % len(SYNTHETIC_SIZES)], seed=n))
+    if not images:
+        parser.error("no images, pass a directory or --synthetic")
+
+    if args.compare_matting:
+        print(json.dumps(compare_matting(images * args.repeat), indent=2))
+        return
+
+    import bot
+
+    def run_bot(output_mode):
+        bot.setup()
+        try:
+            # run on the client's loop, like app.run() does
+            return bot.app.loop.run_until_complete(
+                run(bot, images * args.repeat, args.concurrency, args.reuse_masks, output_mode)
+            )
+        finally:
+            bot.results.close()
+
+    if args.compare_output_modes:
+        results = [run_bot(mode) for mode in OUTPUT_MODES]
+        print(json.dumps(results, indent=2))
+        print(compare_output_modes(results))
+        return
+
+    result = run_bot(args.output_mode)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output)
+    if args.baseline:
+        print(compare(result, json.loads(Path(args.baseline).read_text())))
+
+
+if __name__ == "__main__":
+    main()
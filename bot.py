@@ -1,46 +1,327 @@
 import pyrogram
 import os
-from rembg import remove
 import io
-from PIL import Image
-import os
+import asyncio
+import time
 from dotenv import load_dotenv
 load_dotenv()
+from inference import InferenceExecutor
+from batcher import MicroBatcher
+from media import download_to_buffer
+from cache import ResultCache
+from phash import HashIndex, dhash
+from jobqueue import Busy, JobQueue, QUEUE_DEPTH, job_cost, size_class
+from metrics import Metrics, RATIO_BUCKETS
+from sessions import MODELS
+from client import Client, MEDIA_SESSIONS_PER_DC
+from pyrogram.handlers import MessageHandler
+
+
+# how long to wait for the rest of an album after its first photo
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", "1"))
 
+# built by setup(), not on import: the spawned inference workers import
+# this module too (as __mp_main__)
+app = inference = batcher = results = masks = jobs = metrics = None
 
-api_id = os.environ['API_ID']
-api_hash = os.environ['API_HASH']
-bot_token=os.environ['BOT_TOKEN']
 
-# Create a new client
-app = pyrogram.Client("cutimagebg_bot", api_id, api_hash, bot_token)
+def setup():
+    """Create the client and the shared state and register the handlers."""
+    global app, inference, batcher, results, masks, jobs, metrics
+    api_id = os.environ['API_ID']
+    api_hash = os.environ['API_HASH']
+    bot_token=os.environ['BOT_TOKEN']
+
+    # Create a new client (downloads reuse pooled media sessions), with enough handler workers to answer "busy" when the queue is full
+    # and as many downloads and uploads at once as there are pooled sessions (pyrogram allows one)
+    app = Client(
+        "cutimagebg_bot", api_id, api_hash, bot_token,
+        workers=QUEUE_DEPTH + 8, max_concurrent_transmissions=MEDIA_SESSIONS_PER_DC
+    )
+    app.add_handler(MessageHandler(start, pyrogram.filters.command("start")))
+    app.add_handler(MessageHandler(handle_messages))
+
+    # segmentation runs in worker processes, each one loads the models once
+    inference = InferenceExecutor()
+    # photos arriving together are segmented in a single model call, the
+    # output encoder gets faster as the job queue fills up
+    batcher = MicroBatcher(inference, load=lambda: jobs.size / jobs.depth)
+    # file_unique_id of received images -> file_id of the result we sent
+    results = ResultCache()
+    # masks of recent images, reused for recompressed or resized copies
+    masks = HashIndex()
+    # bounds how many photos are accepted and processed at once
+    jobs = JobQueue()
+    # stage timings and counters, served on METRICS_PORT
+    metrics = Metrics()
+    metrics.histogram("compression_ratio", RATIO_BUCKETS)
+    metrics.gauge("queue_size", lambda: jobs.size)
+    metrics.gauge("queue_rejected", lambda: jobs.rejected)
+    metrics.gauge("queue_expired", lambda: jobs.expired)
+    metrics.gauge("result_cache_hits", lambda: results.hits)
+    metrics.gauge("result_cache_misses", lambda: results.misses)
+    metrics.gauge("phash_hits", lambda: masks.hits)
+    metrics.gauge("phash_misses", lambda: masks.misses)
+    metrics.gauge("media_sessions_created", lambda: app.media_session_pool.created)
+    metrics.gauge("media_sessions_reused", lambda: app.media_session_pool.reused)
+    metrics.gauge("media_auth_handshakes", lambda: app.media_session_pool.handshakes)
+    for q in (50, 95, 99):
+        metrics.gauge(f"queue_wait_p{q}_seconds", lambda q=q: {k: v[f"p{q}"] for k, v in jobs.stats().items()})
 
 
-@app.on_message(pyrogram.filters.command("start"))
 async def start(app,message):
    await message.reply_text("""
 Hi! I am a <b>Background 🖼️ Remover</b> can remove the background from images. 
 Just send an image and let the <b>AI</b> do its magic.""")
 
 
-@app.on_message()
+async def reply_result(message, f):
+    if batcher.output == "photo":
+        return await message.reply_photo(f)
+    if batcher.output == "sticker":
+        return await message.reply_sticker(f)
+    # sent as file so the transparency is kept
+    return await message.reply_document(f, force_document=True)
+
+
+def image_media(message):
+    # photos and images sent uncompressed as files
+    if message.document and (message.document.mime_type or "").startswith("image/"):
+        return message.document
+    return message.photo
+
+
+def sender_id(message):
+    return (message.from_user or message.chat).id
+
+
+async def prepare(media, labels):
+    """Download and hash one image."""
+    # Download the image into memory
+    with metrics.timer("download", **labels):
+        image_bytes = await download_to_buffer(app, media)
+    with metrics.timer("hash", **labels):
+        key = await app.loop.run_in_executor(None, dhash, image_bytes)
+    return image_bytes, key
+
+
+def finish(result, key, labels):
+    """Record the stage timings and the new mask of a processed image,
+    returns the encoded result, its file name and the metrics labels."""
+    new_image, name, new_mask, timings = result
+    metrics.record("compression_ratio", timings.pop("compression_ratio"), **labels)
+    for stage, seconds in timings.items():
+        metrics.observe(stage, seconds, **labels)
+    if new_mask:
+        masks.add(key, new_mask)
+    return new_image, name, labels
+
+
+def labels_for(media):
+    return {"size": size_class(job_cost(media)), "model": MODELS[0]}
+
+
+async def process(message, media, user_id):
+    """Download, segment and encode one image within the job queue limits,
+    returns the encoded result, its file name and the metrics labels."""
+    labels = labels_for(media)
+    async with jobs.job(user_id, job_cost(media)) as waited:
+        metrics.observe("queue", waited, **labels)
+        image_bytes, key = await prepare(media, labels)
+        with metrics.timer("inference", **labels):
+            result = await batcher.submit(image_bytes, masks.lookup(key))
+        return finish(result, key, labels)
+
+
+async def process_album(medias):
+    """process() for the photos of an album, as a single job: all of them
+    are downloaded first and then segmented in one batch. Returns the
+    output or the exception of every photo."""
+    labels = [labels_for(media) for media in medias]
+    async with jobs.job(None, sum(job_cost(media) for media in medias)) as waited:
+        for l in labels:
+            metrics.observe("queue", waited, **l)
+        outputs = await asyncio.gather(
+            *[prepare(media, l) for media, l in zip(medias, labels)], return_exceptions=True
+        )
+        ready = [i for i, output in enumerate(outputs) if not isinstance(output, BaseException)]
+        start = time.perf_counter()
+        batch = await batcher.submit_all([(outputs[i][0], masks.lookup(outputs[i][1])) for i in ready])
+        seconds = time.perf_counter() - start
+        for i, result in zip(ready, batch):
+            metrics.observe("inference", seconds, **labels[i])
+            outputs[i] = result if isinstance(result, BaseException) else finish(result, outputs[i][1], labels[i])
+        return outputs
+
+
+def album_item(file_id):
+    if batcher.output == "photo":
+        return pyrogram.types.InputMediaPhoto(file_id)
+    return pyrogram.types.InputMediaDocument(file_id)
+
+
+async def upload(chat_id, data, name):
+    """Upload a result without sending it, returns it as album item."""
+    with io.BytesIO(data) as f:
+        f.name = name
+        file = await app.save_file(f)
+    peer = await app.resolve_peer(chat_id)
+    if batcher.output == "photo":
+        r = await app.invoke(pyrogram.raw.functions.messages.UploadMedia(
+            peer=peer, media=pyrogram.raw.types.InputMediaUploadedPhoto(file=file)
+        ))
+        return album_item(pyrogram.types.Photo._parse(app, r.photo).file_id)
+    r = await app.invoke(pyrogram.raw.functions.messages.UploadMedia(
+        peer=peer, media=pyrogram.raw.types.InputMediaUploadedDocument(
+            file=file,
+            mime_type=app.guess_mime_type(name) or "application/octet-stream",
+            attributes=[pyrogram.raw.types.DocumentAttributeFilename(file_name=name)],
+            force_file=True
+        )
+    ))
+    return album_item(pyrogram.types.Document._parse(app, r.document, name).file_id)
+
+
+async def album_entry(chat_id, output):
+    # a cached result is sent again by its file_id
+    if isinstance(output, str):
+        return album_item(output)
+    data, name, _ = output
+    return await upload(chat_id, data, name)
+
+
+# media_group_id -> (message, media) of the album photos received so far
+albums = {}
+
+
+async def handle_album(message, media):
+    album = albums.get(message.media_group_id)
+    if album is not None:
+        # the first photo of the album handles it
+        album.append((message, media))
+        return
+    album = albums[message.media_group_id] = [(message, media)]
+    await asyncio.sleep(ALBUM_WINDOW)
+    del albums[message.media_group_id]
+
+    # photos processed before are resent from the cache, the others are
+    # segmented in one batch and count as one job against the per user limit
+    cached = [results.get(media.file_unique_id) for _, media in album]
+    todo = [item for item, file_id in zip(album, cached) if not file_id]
+    processed = iter(await process_items(message, todo) if todo else [])
+    # (message, media, cached file_id or output) in album order
+    done = [(m, media, file_id or next(processed)) for (m, media), file_id in zip(album, cached)]
+    if any(isinstance(output, Busy) for _, _, output in done):
+        await message.reply_text("I'm busy right now, some photos were skipped, please send them again in a minute.")
+    errors = [output for _, _, output in done if isinstance(output, BaseException) and not isinstance(output, Busy)]
+    done = [(m, media, output) for m, media, output in done if not isinstance(output, BaseException)]
+
+    if len(done) == 1 or batcher.output == "sticker":
+        # albums need two items at least and can't hold stickers
+        for m, media, output in done:
+            if isinstance(output, str):
+                try:
+                    await m.reply_cached_media(output)
+                    continue
+                except pyrogram.errors.RPCError:
+                    output = (await process_items(m, [(m, media)]))[0]
+                    if isinstance(output, BaseException):
+                        errors.append(output)
+                        continue
+            await send_result(m, media, *output)
+    elif done:
+        try:
+            await send_album(message, done)
+        except pyrogram.errors.RPCError:
+            if not any(isinstance(output, str) for _, _, output in done):
+                raise
+            # a cached result is no longer valid, process those photos too
+            stale = [(m, media) for m, media, output in done if isinstance(output, str)]
+            fresh = iter(await process_items(message, stale))
+            done = [(m, media, next(fresh) if isinstance(output, str) else output) for m, media, output in done]
+            errors += [output for _, _, output in done if isinstance(output, BaseException)]
+            done = [(m, media, output) for m, media, output in done if not isinstance(output, BaseException)]
+            if len(done) == 1:
+                await send_result(done[0][0], done[0][1], *done[0][2])
+            elif done:
+                await send_album(message, done)
+
+    errors = [e for e in errors if not isinstance(e, Busy)]
+    if errors:
+        raise errors[0]
+
+
+async def process_items(message, items):
+    """process_album for (message, media) items within the per user limit of
+    the sender, returns the output or the exception of every item."""
+    try:
+        with jobs.user(sender_id(message)):
+            return await process_album([media for _, media in items])
+    except Busy:
+        return [Busy()] * len(items)
+
+
+async def send_album(message, done):
+    # the uploads run at once, MEDIA_SESSIONS_PER_DC at a time (see setup)
+    with metrics.timer("upload", **labels_for(done[0][1])):
+        items = await asyncio.gather(*[album_entry(message.chat.id, output) for _, _, output in done])
+        sent = await app.send_media_group(message.chat.id, items, reply_to_message_id=message.id)
+    for (_, media, _), s in zip(done, sent):
+        results.put(media.file_unique_id, (s.photo or s.document).file_id)
+
+
+async def send_result(message, media, data, name, labels):
+    # send the processed image
+    with metrics.timer("upload", **labels), io.BytesIO(data) as f:
+        f.name = name
+        sent = await reply_result(message, f)
+    results.put(media.file_unique_id, (sent.photo or sent.sticker or sent.document).file_id)
+
+
 async def handle_messages(app, message):
-    if message.photo:
-        # Download the image
-        image_file = message.photo.file_id
-        image_path = await app.download_media(image_file)
-        #open the image file
-        with open(image_path, "rb") as image_file:
-            image_bytes = image_file.read()
-            new_image = remove(image_bytes)
-        #save the file as valid image and send it
-        image = Image.open(io.BytesIO(new_image))
-        with io.BytesIO() as f:
-            image.save(f, format='png')
-            f.seek(0)
-            await message.reply_photo(f)
-        # remove the image after it has been processed and sent
-        os.remove(image_path)
+    media = image_media(message)
+    if not media:
+        return
+    if message.media_group_id:
+        await handle_album(message, media)
+        return
+    # the same image was processed before, resend the stored result
+    file_id = results.get(media.file_unique_id)
+    if file_id:
+        try:
+            await message.reply_cached_media(file_id)
+            return
+        except pyrogram.errors.RPCError:
+            pass
+    try:
+        data, name, labels = await process(message, media, sender_id(message))
+    except Busy:
+        await message.reply_text("I'm busy right now, please try again in a minute.")
+        return
+    await send_result(message, media, data, name, labels)
+
+
+async def main():
+    # load the models and compile the matting kernels before taking updates
+    seconds, reports = await inference.warm_up()
+    for report in reports:
+        if not report["numba_cache_writable"]:
+            print(f"numba cache dir {report['numba_cache_dir']} is not writable, set NUMBA_CACHE_DIR")
+    for model, batched in reports[0]["batched"].items():
+        if not batched:
+            print(f"{model} runs one image per forward pass, it has a fixed batch size or no batched path")
+    print(f"Warm-up of {len(set(r['pid'] for r in reports))} workers done in {seconds:.1f}s")
+    await metrics.start_server()
+    async with app:
+        await pyrogram.idle()
+    await metrics.stop_server()
+
 
 # Start the bot
-app.run()
+if __name__ == "__main__":
+    setup()
+    try:
+        app.run(main())
+    finally:
+        inference.shutdown()
+        results.close()
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "10000"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "results.db")
+
+
+class ResultCache:
+    """Maps the file_unique_id of a received image to the file_id of the
+    result we already sent for it, so repeats can be answered with
+    send_cached_media. Recent entries are kept in memory, all of them in a
+    sqlite index on disk."""
+
+    def __init__(self, path=RESULT_CACHE_PATH, capacity=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(file_unique_id TEXT PRIMARY KEY, file_id TEXT NOT NULL, date INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+        self.purge()
+
+    def get(self, file_unique_id):
+        now = time.time()
+        entry = self.memory.get(file_unique_id)
+        if entry is None:
+            row = self.conn.execute(
+                "SELECT file_id, date FROM results WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+            entry = tuple(row) if row else None
+
+        if entry is None or entry[1] + self.ttl < now:
+            self.memory.pop(file_unique_id, None)
+            self.misses += 1
+            return None
+
+        self.remember(file_unique_id, entry)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, file_unique_id, file_id):
+        entry = (file_id, int(time.time()))
+        self.remember(file_unique_id, entry)
+        self.conn.execute(
+            "REPLACE INTO results (file_unique_id, file_id, date) VALUES (?, ?, ?)",
+            (file_unique_id, *entry)
+        )
+        self.conn.commit()
+
+    def remember(self, file_unique_id, entry):
+        self.memory[file_unique_id] = entry
+        self.memory.move_to_end(file_unique_id)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def purge(self):
+        self.conn.execute("DELETE FROM results WHERE date < ?", (int(time.time()) - self.ttl,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,641 @@
+import asyncio
+import functools
+import inspect
+import io
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from hashlib import md5, sha256
+from pathlib import PurePath
+from typing import AsyncGenerator, BinaryIO, Callable, Optional, Union
+
+import pyrogram
+from pyrogram import raw, utils
+from pyrogram.crypto import aes
+from pyrogram.errors import AuthKeyUnregistered, CDNFileHashMismatch, RPCError, VolumeLocNotFound
+from pyrogram.file_id import FileId, FileType, ThumbnailSource
+from pyrogram.session import Auth, Session
+
+log = logging.getLogger(__name__)
+
+MEDIA_SESSIONS_PER_DC = int(os.environ.get("MEDIA_SESSIONS_PER_DC", "4"))
+MEDIA_SESSION_IDLE_TIMEOUT = float(os.environ.get("MEDIA_SESSION_IDLE_TIMEOUT", "300"))
+# idle sessions older than this are pinged before being reused
+MEDIA_SESSION_PING_AFTER = float(os.environ.get("MEDIA_SESSION_PING_AFTER", "60"))
+# a session started with a stored auth key the server has forgotten never
+# gets past its first ping, after this many seconds the key is replaced
+MEDIA_SESSION_START_TIMEOUT = float(os.environ.get("MEDIA_SESSION_START_TIMEOUT", "10"))
+# 1 MiB chunk requests in flight per download
+GET_FILE_WINDOW = int(os.environ.get("GET_FILE_WINDOW", "4"))
+# files are striped over up to DOWNLOAD_STRIPES sessions, one per
+# STRIPE_SIZE bytes, but only as many as it takes to download them in
+# STRIPE_TARGET_SECONDS at the throughput seen per session so far
+DOWNLOAD_STRIPES = int(os.environ.get("DOWNLOAD_STRIPES", "4"))
+STRIPE_SIZE = int(os.environ.get("STRIPE_SIZE", 8 * 1024 * 1024))
+STRIPE_TARGET_SECONDS = float(os.environ.get("STRIPE_TARGET_SECONDS", "2"))
+# 512 KB parts sent at once per upload session
+UPLOAD_WINDOW = int(os.environ.get("UPLOAD_WINDOW", "4"))
+# the MD5 of small uploads is optional, the server only checks it if given
+UPLOAD_MD5 = os.environ.get("UPLOAD_MD5", "0") == "1"
+
+# auth keys of the other DCs, already authorized for the account with
+# ImportAuthorization, kept in the session file next to pyrogram's tables
+# language=SQLite
+MEDIA_AUTH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_auth_keys
+(
+    dc_id     INTEGER,
+    test_mode INTEGER,
+    user_id   INTEGER,
+    auth_key  BLOB,
+    date      INTEGER NOT NULL,
+    PRIMARY KEY (dc_id, test_mode, user_id)
+);
+"""
+
+
+class MediaSessionPool:
+    """Started media sessions per DC, reused across downloads and uploads
+    instead of connecting, pinging and authorizing a new session for every
+    file."""
+
+    def __init__(self, client, size=MEDIA_SESSIONS_PER_DC, idle_timeout=MEDIA_SESSION_IDLE_TIMEOUT,
+                 ping_after=MEDIA_SESSION_PING_AFTER, start_timeout=MEDIA_SESSION_START_TIMEOUT):
+        self.client = client
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.start_timeout = start_timeout
+        # dc_id -> list of (session, last used), kept apart from the client's
+        # media_sessions, pyrogram expects sessions there and stops them itself
+        self.idle = {}
+        self.closed = False
+        self.slots = {}
+        self.reaper = None
+        self.created = 0
+        self.reused = 0
+        self.handshakes = 0
+
+    async def create(self, dc_id):
+        client = self.client
+        test_mode = await client.storage.test_mode()
+        is_home = dc_id == await client.storage.dc_id()
+
+        if is_home:
+            auth_key = await client.storage.auth_key()
+        else:
+            auth_key = await client.media_auth_key(dc_id)
+        authorized = is_home or auth_key is not None
+
+        session = None
+        if not is_home and auth_key is not None:
+            session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            try:
+                await asyncio.wait_for(session.start(), self.start_timeout)
+            except (asyncio.TimeoutError, OSError, RPCError):
+                # the server answers pings on an unknown key with a transport
+                # error and Session.start reconnects over and over
+                log.warning("Stored auth key for DC%s was not accepted, creating a new one", dc_id)
+                await session.stop()
+                await client.media_auth_key(dc_id, None)
+                session = None
+                auth_key = None
+                authorized = False
+
+        if session is None:
+            if auth_key is None:
+                auth_key = await Auth(client, dc_id, test_mode).create()
+                self.handshakes += 1
+            session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await session.start()
+
+        try:
+            if not authorized:
+                exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                await session.invoke(
+                    raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes)
+                )
+                await client.media_auth_key(dc_id, auth_key)
+        except BaseException:
+            await session.stop()
+            raise
+
+        self.created += 1
+        return session
+
+    async def reauthorize(self, dc_id, session):
+        """Replace a session whose key the server no longer knows."""
+        await session.stop()
+        await self.client.media_auth_key(dc_id, None)
+        return await self.create(dc_id)
+
+    async def is_healthy(self, session, last_used):
+        if time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            await session.invoke(raw.functions.Ping(ping_id=0), retries=0, timeout=5)
+        except Exception:
+            return False
+        return True
+
+    async def acquire(self, dc_id):
+        if self.reaper is None:
+            self.reaper = asyncio.get_running_loop().create_task(self.reap())
+
+        slots = self.slots.setdefault(dc_id, asyncio.Semaphore(self.size))
+        await slots.acquire()
+        try:
+            idle = self.idle.setdefault(dc_id, [])
+            while idle:
+                session, last_used = idle.pop()
+                if await self.is_healthy(session, last_used):
+                    self.reused += 1
+                    return session
+                await session.stop()
+            return await self.create(dc_id)
+        except BaseException:
+            slots.release()
+            raise
+
+    def available(self, dc_id):
+        """Whether a session of the DC can be borrowed without waiting."""
+        slots = self.slots.get(dc_id)
+        return slots is None or not slots.locked()
+
+    async def release(self, dc_id, session, healthy=True):
+        if session is None:
+            pass
+        elif healthy and not self.closed:
+            self.idle.setdefault(dc_id, []).append((session, time.monotonic()))
+        else:
+            await session.stop()
+        self.slots[dc_id].release()
+
+    @asynccontextmanager
+    async def session(self, dc_id):
+        lease = MediaSession(self, dc_id, await self.acquire(dc_id))
+        healthy = True
+        try:
+            yield lease
+        except (RPCError, pyrogram.StopTransmission, asyncio.CancelledError, GeneratorExit):
+            # the connection itself is fine
+            raise
+        except BaseException:
+            healthy = False
+            raise
+        finally:
+            await self.release(dc_id, lease.session, healthy)
+
+    async def reap(self):
+        # stop the sessions nobody used for idle_timeout
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            # acquire() may add a DC while a session is stopping
+            for dc_id, idle in list(self.idle.items()):
+                expired = [(s, t) for s, t in idle if now - t > self.idle_timeout]
+                idle[:] = [(s, t) for s, t in idle if now - t <= self.idle_timeout]
+                for session, _ in expired:
+                    await session.stop()
+
+    async def close(self):
+        # sessions still on loan are stopped when they come back
+        self.closed = True
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+        idle, self.idle = self.idle, {}
+        for sessions in idle.values():
+            for session, _ in sessions:
+                await session.stop()
+
+
+class MediaSession:
+    """A pooled session on loan. If the server dropped the key of another
+    DC (AUTH_KEY_UNREGISTERED), the session is authorized again and the
+    request retried once."""
+
+    def __init__(self, pool, dc_id, session):
+        self.pool = pool
+        self.dc_id = dc_id
+        self.session = session
+        # several requests run on one lease, only the first to fail re-authorizes
+        self.lock = asyncio.Lock()
+
+    async def invoke(self, query, **kwargs):
+        session = self.session
+        try:
+            return await session.invoke(query, **kwargs)
+        except AuthKeyUnregistered:
+            if self.dc_id == await self.pool.client.storage.dc_id():
+                raise
+            async with self.lock:
+                if self.session is session:
+                    self.session = None
+                    self.session = await self.pool.reauthorize(self.dc_id, session)
+                elif self.session is None:
+                    # the re-authorization of another request failed
+                    raise
+            return await self.session.invoke(query, **kwargs)
+
+
+class Client(pyrogram.Client):
+    """pyrogram.Client with pooled media sessions for downloads and uploads
+    and the auth keys of other DCs kept in the session storage."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.media_session_pool = MediaSessionPool(self)
+        self.get_file_window = GET_FILE_WINDOW
+        self.upload_window = UPLOAD_WINDOW
+        # bytes per second of one media session, moving average
+        self.session_throughput = None
+
+    async def stop(self, block: bool = True):
+        await self.media_session_pool.close()
+        return await super().stop(block)
+
+    async def load_session(self):
+        await super().load_session()
+        with self.storage.conn:
+            self.storage.conn.executescript(MEDIA_AUTH_SCHEMA)
+
+    async def media_auth_key(self, dc_id, value=object):
+        """Get, set or (with None) delete the stored auth key of another DC."""
+        key = (dc_id, await self.storage.test_mode(), await self.storage.user_id())
+        conn = self.storage.conn
+
+        if value is object:
+            r = conn.execute(
+                "SELECT auth_key FROM media_auth_keys WHERE dc_id = ? AND test_mode = ? AND user_id = ?", key
+            ).fetchone()
+            return r[0] if r else None
+
+        with conn:
+            if value is None:
+                conn.execute("DELETE FROM media_auth_keys WHERE dc_id = ? AND test_mode = ? AND user_id = ?", key)
+            else:
+                conn.execute(
+                    "REPLACE INTO media_auth_keys VALUES (?, ?, ?, ?, ?)", (*key, value, int(time.time()))
+                )
+
+    @staticmethod
+    def file_location(file_id: FileId):
+        file_type = file_id.file_type
+
+        if file_type == FileType.CHAT_PHOTO:
+            if file_id.chat_id > 0:
+                peer = raw.types.InputPeerUser(
+                    user_id=file_id.chat_id,
+                    access_hash=file_id.chat_access_hash
+                )
+            else:
+                if file_id.chat_access_hash == 0:
+                    peer = raw.types.InputPeerChat(
+                        chat_id=-file_id.chat_id
+                    )
+                else:
+                    peer = raw.types.InputPeerChannel(
+                        channel_id=utils.get_channel_id(file_id.chat_id),
+                        access_hash=file_id.chat_access_hash
+                    )
+
+            return raw.types.InputPeerPhotoFileLocation(
+                peer=peer,
+                photo_id=file_id.media_id,
+                big=file_id.thumbnail_source == ThumbnailSource.CHAT_PHOTO_BIG
+            )
+        elif file_type == FileType.PHOTO:
+            return raw.types.InputPhotoFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
+            )
+        else:
+            return raw.types.InputDocumentFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
+            )
+
+    def stripe_count(self, size):
+        stripes = min(DOWNLOAD_STRIPES, size // STRIPE_SIZE)
+        if self.session_throughput:
+            stripes = min(stripes, math.ceil(size / self.session_throughput / STRIPE_TARGET_SECONDS))
+        return max(stripes, 1)
+
+    def observe_throughput(self, size, seconds):
+        if seconds <= 0:
+            return
+        throughput = size / seconds
+        if self.session_throughput is None:
+            self.session_throughput = throughput
+        else:
+            self.session_throughput += 0.2 * (throughput - self.session_throughput)
+
+    async def report_progress(self, progress, progress_args, current, file_size):
+        func = functools.partial(
+            progress,
+            min(current, file_size) if file_size != 0 else current,
+            file_size,
+            *progress_args
+        )
+
+        if inspect.iscoroutinefunction(progress):
+            await func()
+        else:
+            await self.loop.run_in_executor(self.executor, func)
+
+    async def get_file(
+        self,
+        file_id: FileId,
+        file_size: int = 0,
+        limit: int = 0,
+        offset: int = 0,
+        progress: Callable = None,
+        progress_args: tuple = ()
+    ) -> Optional[AsyncGenerator[bytes, None]]:
+        """Same as pyrogram.Client.get_file, with the media session borrowed
+        from the per DC pool and up to get_file_window chunk requests in
+        flight at once instead of one per round trip. Big files are striped
+        over several sessions of the DC, only over the ones free right away
+        so concurrent downloads can't wait on each other's sessions."""
+        async with self.get_file_semaphore:
+            location = self.file_location(file_id)
+
+            current = 0
+            total = abs(limit) or (1 << 31) - 1
+            chunk_size = 1024 * 1024
+            offset_bytes = abs(offset) * chunk_size
+            if file_size:
+                # don't ask for chunks past the end
+                total = min(total, max(-(-(file_size - offset_bytes) // chunk_size), 1))
+
+            try:
+                async with AsyncExitStack() as stack:
+                    session = await stack.enter_async_context(self.media_session_pool.session(file_id.dc_id))
+                    # big files are striped, chunk i goes to sessions[i % len(sessions)]
+                    sessions = [session]
+                    for _ in range(self.stripe_count(min(file_size - offset_bytes, total * chunk_size)) - 1):
+                        if not self.media_session_pool.available(file_id.dc_id):
+                            break
+                        sessions.append(
+                            await stack.enter_async_context(self.media_session_pool.session(file_id.dc_id))
+                        )
+
+                    def request(i):
+                        return asyncio.ensure_future(sessions[i % len(sessions)].invoke(
+                            raw.functions.upload.GetFile(
+                                location=location,
+                                offset=first_offset + i * chunk_size,
+                                limit=chunk_size
+                            ),
+                            sleep_threshold=30
+                        ))
+
+                    first_offset = offset_bytes
+                    start = time.monotonic()
+                    requested = 0
+                    pending = deque()
+                    try:
+                        while current < total:
+                            while requested < total and len(pending) < self.get_file_window * len(sessions):
+                                pending.append(request(requested))
+                                requested += 1
+
+                            r = await pending.popleft()
+
+                            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                                async for chunk in self.get_cdn_file(
+                                    session, r, offset_bytes, chunk_size, total - current,
+                                    file_size, progress, progress_args
+                                ):
+                                    yield chunk
+                                break
+
+                            chunk = r.bytes
+
+                            yield chunk
+
+                            current += 1
+                            offset_bytes += chunk_size
+
+                            if progress:
+                                await self.report_progress(progress, progress_args, offset_bytes, file_size)
+
+                            if len(chunk) < chunk_size:
+                                break
+                    finally:
+                        # wait for the requests still in flight rather than
+                        # cancel them, the session would keep their result
+                        # slots forever
+                        await asyncio.gather(*pending, return_exceptions=True)
+
+                    if current > 1:
+                        self.observe_throughput((offset_bytes - first_offset) / len(sessions), time.monotonic() - start)
+            except pyrogram.StopTransmission:
+                raise
+            except Exception as e:
+                log.exception(e)
+
+    async def save_file(
+        self,
+        path: Union[str, BinaryIO],
+        file_id: int = None,
+        file_part: int = 0,
+        progress: Callable = None,
+        progress_args: tuple = ()
+    ):
+        """Same as pyrogram.Client.save_file, with the session borrowed from
+        the pool, up to upload_window parts in flight also for small files
+        and the MD5 left out, or computed off the loop with UPLOAD_MD5."""
+        async with self.save_file_semaphore:
+            if path is None:
+                return None
+
+            part_size = 512 * 1024
+
+            if isinstance(path, (str, PurePath)):
+                fp = open(path, "rb")
+            elif isinstance(path, io.IOBase):
+                fp = path
+            else:
+                raise ValueError("Invalid file. Expected a file path as string or a binary (not text) file pointer")
+
+            file_name = getattr(fp, "name", "file.jpg")
+
+            fp.seek(0, os.SEEK_END)
+            file_size = fp.tell()
+            fp.seek(0)
+
+            if file_size == 0:
+                raise ValueError("File size equals to 0 B")
+
+            file_size_limit_mib = 4000 if self.me.is_premium else 2000
+
+            if file_size > file_size_limit_mib * 1024 * 1024:
+                raise ValueError(f"Can't upload files bigger than {file_size_limit_mib} MiB")
+
+            file_total_parts = int(math.ceil(file_size / part_size))
+            is_big = file_size > 10 * 1024 * 1024
+            is_missing_part = file_id is not None
+            file_id = file_id or self.rnd_id()
+            md5_sum = md5() if UPLOAD_MD5 and not is_big and not is_missing_part else None
+            dc_id = await self.storage.dc_id()
+
+            try:
+                async with AsyncExitStack() as stack:
+                    sessions = [await stack.enter_async_context(self.media_session_pool.session(dc_id))]
+                    if is_big and not is_missing_part:
+                        for _ in range(self.stripe_count(file_size) - 1):
+                            if not self.media_session_pool.available(dc_id):
+                                break
+                            sessions.append(await stack.enter_async_context(self.media_session_pool.session(dc_id)))
+
+                    # parts may arrive in any order
+                    pending = set()
+                    try:
+                        fp.seek(part_size * file_part)
+
+                        while True:
+                            chunk = fp.read(part_size)
+
+                            if not chunk:
+                                break
+
+                            if is_big:
+                                rpc = raw.functions.upload.SaveBigFilePart(
+                                    file_id=file_id,
+                                    file_part=file_part,
+                                    file_total_parts=file_total_parts,
+                                    bytes=chunk
+                                )
+                            else:
+                                rpc = raw.functions.upload.SaveFilePart(
+                                    file_id=file_id,
+                                    file_part=file_part,
+                                    bytes=chunk
+                                )
+
+                            if len(pending) >= self.upload_window * len(sessions):
+                                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                                for task in done:
+                                    task.result()
+
+                            pending.add(asyncio.ensure_future(sessions[file_part % len(sessions)].invoke(rpc)))
+
+                            if is_missing_part:
+                                await asyncio.gather(*pending)
+                                return
+
+                            if md5_sum:
+                                # hashlib releases the GIL on big buffers
+                                await self.loop.run_in_executor(self.executor, md5_sum.update, chunk)
+
+                            file_part += 1
+
+                            if progress:
+                                await self.report_progress(progress, progress_args, file_part * part_size, file_size)
+
+                        await asyncio.gather(*pending)
+                    finally:
+                        # as in get_file, never cancel requests in flight
+                        await asyncio.gather(*pending, return_exceptions=True)
+            except pyrogram.StopTransmission:
+                raise
+            except Exception as e:
+                log.exception(e)
+            else:
+                if is_big:
+                    return raw.types.InputFileBig(
+                        id=file_id,
+                        parts=file_total_parts,
+                        name=file_name,
+                    )
+                else:
+                    return raw.types.InputFile(
+                        id=file_id,
+                        parts=file_total_parts,
+                        name=file_name,
+                        md5_checksum=md5_sum.hexdigest() if md5_sum else ""
+                    )
+            finally:
+                if isinstance(path, (str, PurePath)):
+                    fp.close()
+
+    async def get_cdn_file(self, session, r, offset_bytes, chunk_size, total, file_size, progress, progress_args):
+        current = 0
+        cdn_session = Session(
+            self, r.dc_id, await Auth(self, r.dc_id, await self.storage.test_mode()).create(),
+            await self.storage.test_mode(), is_media=True, is_cdn=True
+        )
+
+        try:
+            await cdn_session.start()
+
+            while True:
+                r2 = await cdn_session.invoke(
+                    raw.functions.upload.GetCdnFile(
+                        file_token=r.file_token,
+                        offset=offset_bytes,
+                        limit=chunk_size
+                    )
+                )
+
+                if isinstance(r2, raw.types.upload.CdnFileReuploadNeeded):
+                    try:
+                        await session.invoke(
+                            raw.functions.upload.ReuploadCdnFile(
+                                file_token=r.file_token,
+                                request_token=r2.request_token
+                            )
+                        )
+                    except VolumeLocNotFound:
+                        break
+                    else:
+                        continue
+
+                chunk = r2.bytes
+
+                # https://core.telegram.org/cdn#decrypting-files
+                decrypted_chunk = aes.ctr256_decrypt(
+                    chunk,
+                    r.encryption_key,
+                    bytearray(
+                        r.encryption_iv[:-4]
+                        + (offset_bytes // 16).to_bytes(4, "big")
+                    )
+                )
+
+                hashes = await session.invoke(
+                    raw.functions.upload.GetCdnFileHashes(
+                        file_token=r.file_token,
+                        offset=offset_bytes
+                    )
+                )
+
+                # https://core.telegram.org/cdn#verifying-files
+                for i, h in enumerate(hashes):
+                    cdn_chunk = decrypted_chunk[h.limit * i: h.limit * (i + 1)]
+                    CDNFileHashMismatch.check(
+                        h.hash == sha256(cdn_chunk).digest(),
+                        "h.hash == sha256(cdn_chunk).digest()"
+                    )
+
+                yield decrypted_chunk
+
+                current += 1
+                offset_bytes += chunk_size
+
+                if progress:
+                    await self.report_progress(progress, progress_args, offset_bytes, file_size)
+
+                if len(chunk) < chunk_size or current >= total:
+                    break
+        finally:
+            await cdn_session.stop()
@@ -0,0 +1,103 @@
+import io
+import os
+
+from PIL import Image
+
+# photo: PNG sent as photo (Telegram recompresses it and drops the transparency)
+# document: PNG sent as file, webp: WebP with alpha sent as file
+# sticker: 512 px WebP sticker, auto: the smaller of PNG and WebP, sent as file
+OUTPUT_MODES = ("photo", "document", "webp", "sticker", "auto")
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "photo")
+WEBP_LOSSLESS = os.environ.get("WEBP_LOSSLESS", "1") == "1"
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", "90"))
+# in auto mode WebP is only tried for PNGs bigger than this
+AUTO_WEBP_BYTES = int(os.environ.get("AUTO_WEBP_BYTES", str(1024 * 1024)))
+# zlib level 0-9 for the PNG output, or "auto" to pick it from the queue load
+PNG_COMPRESS_LEVEL = os.environ.get("PNG_COMPRESS_LEVEL", "auto")
+
+# zlib strategies, passed to Pillow as compress_type
+Z_DEFAULT_STRATEGY = 0
+Z_RLE = 3
+
+# (queue load below which it applies, zlib level, zlib strategy), idle first.
+# RLE is much faster than the default strategy and does well on the large
+# fully transparent areas of a cutout.
+PNG_PRESETS = [
+    (0.25, 6, Z_DEFAULT_STRATEGY),
+    (0.75, 3, Z_RLE),
+    (float("inf"), 1, Z_RLE),
+]
+
+# point() table selecting the pixels of a mask that are fully transparent
+TRANSPARENT = [255] + [0] * 255
+
+
+def open_image(image_bytes, mode="RGB", size=None):
+    """Decode the uploaded image into RGB. When only a small copy is needed,
+    pass its size and JPEGs are decoded with draft() at 1/2, 1/4 or 1/8 scale
+    (the smallest one still at least that big)."""
+    image = Image.open(io.BytesIO(image_bytes))
+    if size:
+        image.draft(mode, size)
+    if image.mode != mode:
+        image = image.convert(mode)
+    else:
+        image.load()
+    return image
+
+
+def downscale(image, size):
+    """Model input from the decoded image. reducing_gap lets Pillow shrink by
+    whole factors first so the cost doesn't grow with the upload resolution."""
+    return image.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
+
+def composite(image, mask):
+    """Upsample the single channel mask and apply it as alpha channel, in
+    place on the decoded RGB image (Pillow keeps RGB as 4 bytes per pixel, so
+    no RGBA copy is made). Fully transparent pixels are cleared to
+    (0, 0, 0, 0) as in rembg's cutout, so the removed background isn't
+    kept under alpha 0 and the encoders get long runs of zeros."""
+    if mask.size != image.size:
+        mask = mask.resize(image.size, Image.BILINEAR)
+    image.putalpha(mask)
+    image.paste((0, 0, 0, 0), mask=mask.point(TRANSPARENT))
+    return image
+
+
+def encode(image, format="png", **params):
+    """The only encode of the output, straight from the RGBA pixels."""
+    with io.BytesIO() as f:
+        image.save(f, format=format, **params)
+        return f.getvalue()
+
+
+def png_params(load=0.0):
+    """PNG encoder settings for the current queue load (0 idle, 1 full):
+    smaller files when idle, faster encoding when busy."""
+    if PNG_COMPRESS_LEVEL != "auto":
+        return {"compress_level": int(PNG_COMPRESS_LEVEL)}
+    level, strategy = next((level, strategy) for limit, level, strategy in PNG_PRESETS if load < limit)
+    return {"compress_level": level, "compress_type": strategy}
+
+
+def encode_webp(image):
+    return encode(image, "webp", lossless=WEBP_LOSSLESS, quality=WEBP_QUALITY, method=4)
+
+
+def encode_output(image, mode=OUTPUT_MODE, load=0.0):
+    """Encode the result for the given output mode, returns the bytes and
+    the file name to send them with."""
+    if mode == "sticker":
+        # stickers need their longest side at exactly 512 px
+        scale = 512 / max(image.size)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+        return encode(image, "webp", quality=WEBP_QUALITY, method=4), "sticker.webp"
+    if mode == "webp":
+        return encode_webp(image), "result.webp"
+    png = encode(image, **png_params(load))
+    if mode == "auto" and len(png) > AUTO_WEBP_BYTES:
+        webp = encode_webp(image)
+        if len(webp) < len(png):
+            return webp, "result.webp"
+    return png, "result.png"
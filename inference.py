@@ -0,0 +1,272 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+from imaging import OUTPUT_MODE, composite, downscale, encode, encode_output, open_image
+from matting import ALPHA_MATTING, cutout
+from sessions import SessionPool
+
+# every worker runs its models on cpu_count // INFERENCE_WORKERS threads so
+# together they don't start more threads than there are cores
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+
+# same normalization rembg uses for the u2net family
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# models with that normalization and a single mask output, segmented by
+# segment_batch, the others (isnet-general-use, u2net_cloth_seg, ...) one
+# image at a time with their own rembg predict
+BATCHED_MODELS = {"u2net", "u2netp", "u2net_human_seg", "silueta"}
+
+# set in every worker process by init_worker
+sessions = None
+warm_up_report = None
+
+
+def init_worker(workers):
+    global sessions, warm_up_report
+    start = time.perf_counter()
+    sessions = SessionPool(threads=max(1, (os.cpu_count() or 1) // workers))
+    warm_up_report = warm_up()
+    warm_up_report["seconds"] = time.perf_counter() - start
+
+
+def numba_cache_dir():
+    """Where numba keeps the compiled pymatting kernels, they are only loaded
+    from cache on later starts if it is writable."""
+    import pymatting
+    return os.environ.get("NUMBA_CACHE_DIR") or os.path.dirname(pymatting.__file__)
+
+
+def warm_up():
+    """Push a dummy image through every model and the configured matting so
+    the ONNX sessions are initialised and the numba kernels compiled (or
+    loaded from cache) before the first photo arrives."""
+    image = Image.new("RGB", (256, 256), (30, 120, 200))
+    ImageDraw.Draw(image).ellipse((64, 48, 192, 224), fill=(240, 200, 160))
+    image_bytes = encode(image, "jpeg")
+    for model in sessions.models:
+        result = remove_background_batch([(image_bytes, None)], model)[0]
+        if isinstance(result, Exception):
+            raise result
+
+    if ALPHA_MATTING != "off":
+        # a soft edged mask, so the matting has an unknown band to solve
+        mask = Image.new("L", image.size, 0)
+        ImageDraw.Draw(mask).ellipse((64, 48, 192, 224), fill=255)
+        cutout(image, mask.filter(ImageFilter.GaussianBlur(6)), ALPHA_MATTING)
+
+    cache_dir = numba_cache_dir()
+    batched = {}
+    for model in sessions.models:
+        with sessions.session(model) as session:
+            batched[model] = model in BATCHED_MODELS and not fixed_batch_size(session)
+    return {
+        "pid": os.getpid(),
+        "models": sessions.models,
+        # False for the models that run one image per forward pass
+        "batched": batched,
+        "matting": ALPHA_MATTING,
+        "numba_cache_dir": cache_dir,
+        "numba_cache_writable": os.access(cache_dir, os.W_OK),
+    }
+
+
+def worker_report(barrier=None):
+    # waiting on the barrier keeps a worker from answering two of the calls
+    if barrier is not None:
+        barrier.wait()
+    return dict(warm_up_report, cpu_time=time.process_time())
+
+
+def input_size(session):
+    shape = session.inner_session.get_inputs()[0].shape
+    if all(isinstance(d, int) for d in shape[2:]):
+        return shape[3], shape[2]
+    return 320, 320
+
+
+def normalize(image):
+    im = np.asarray(image, dtype=np.float32)
+    im = im / max(float(im.max()), 1e-6)
+    im = (im - MEAN) / STD
+    return im.transpose(2, 0, 1)
+
+
+def fixed_batch_size(session):
+    """Whether the ONNX model was exported with a fixed batch dimension."""
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return isinstance(batch_dim, int)
+
+
+def segment_batch(session, images_bytes, timings=None):
+    """Run one forward pass over all images and return one L mask per image
+    at the model resolution (or the exception if it couldn't be decoded).
+    The model input is decoded at reduced scale, the full resolution decode
+    is left for the composite. Stage times go in `timings` if given."""
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    size = input_size(session)
+    masks = [None] * len(images_bytes)
+    inputs = []
+    for i, image_bytes in enumerate(images_bytes):
+        try:
+            inputs.append((i, normalize(downscale(open_image(image_bytes, size=size), size))))
+        except Exception as e:
+            masks[i] = e
+    if not inputs:
+        return masks
+
+    batch = np.stack([im for _, im in inputs])
+    timings["preprocess"] = time.perf_counter() - start
+    start = time.perf_counter()
+    name = session.inner_session.get_inputs()[0].name
+
+    if fixed_batch_size(session) and len(batch) > 1:
+        # the model was exported with a fixed batch size, fall back to one image per run
+        preds = np.concatenate([
+            session.inner_session.run(None, {name: batch[i:i + 1]})[0][:, 0]
+            for i in range(len(batch))
+        ])
+    else:
+        preds = session.inner_session.run(None, {name: batch})[0][:, 0]
+    timings["model"] = time.perf_counter() - start
+
+    for (i, _), pred in zip(inputs, preds):
+        ma, mi = pred.max(), pred.min()
+        pred = (pred - mi) / max(ma - mi, 1e-6)
+        masks[i] = Image.fromarray((pred * 255).astype(np.uint8), mode="L")
+    return masks
+
+
+def segment_each(session, images_bytes, timings=None):
+    """segment_batch for the models outside BATCHED_MODELS: rembg's own
+    predict per image, the masks of multi-mask models (cloth parts) are
+    merged into one."""
+    timings = {} if timings is None else timings
+    timings["model"] = 0.0
+    masks = []
+    for image_bytes in images_bytes:
+        try:
+            image = open_image(image_bytes)
+            start = time.perf_counter()
+            predicted = session.predict(image)
+            timings["model"] += time.perf_counter() - start
+            mask = predicted[0]
+            for other in predicted[1:]:
+                mask = ImageChops.lighter(mask, other)
+            masks.append(mask)
+        except Exception as e:
+            masks.append(e)
+    return masks
+
+
+def remove_background_batch(jobs, model=None, output=OUTPUT_MODE, load=0.0):
+    """Remove the background of several images with a single model call.
+
+    Every job is a pair of image bytes and an optional low resolution mask
+    to reuse instead of running the model. Returns for every job either the
+    exception or the encoded result with its file name (see encode_output),
+    the newly computed mask (None if reused) and a dict with the time spent
+    in every stage (plus the compression ratio of the output). `load` is the
+    queue load the output encoder settings are picked for.
+    """
+    results = [None] * len(jobs)
+    pending = [i for i, (_, mask_bytes) in enumerate(jobs) if not mask_bytes]
+    new_masks = {}
+    batch_timings = {}
+    if pending:
+        segment = segment_batch if (model or sessions.default_model) in BATCHED_MODELS else segment_each
+        with sessions.session(model) as session:
+            masks = segment(session, [jobs[i][0] for i in pending], batch_timings)
+        new_masks = dict(zip(pending, masks))
+        # the batch stages are shared, every image gets its part so the
+        # stage totals still add up to the time spent
+        batch_timings = {stage: seconds / len(pending) for stage, seconds in batch_timings.items()}
+
+    # one full resolution image at a time, released as soon as it is encoded
+    for i, (image_bytes, mask_bytes) in enumerate(jobs):
+        new_mask = new_masks.get(i)
+        if isinstance(new_mask, Exception):
+            results[i] = new_mask
+            continue
+        timings = dict(batch_timings) if new_mask is not None else {}
+        try:
+            start = time.perf_counter()
+            mask = new_mask if new_mask is not None else open_image(mask_bytes, "L")
+            image = open_image(image_bytes)
+            timings["decode"] = time.perf_counter() - start
+            start = time.perf_counter()
+            if ALPHA_MATTING == "off":
+                image = composite(image, mask)
+                timings["composite"] = time.perf_counter() - start
+            else:
+                image = cutout(image, mask.resize(image.size, Image.BILINEAR))
+                timings["matting"] = time.perf_counter() - start
+            start = time.perf_counter()
+            data, name = encode_output(image, output, load)
+            timings["encode"] = time.perf_counter() - start
+            timings["compression_ratio"] = image.width * image.height * 4 / len(data)
+            del image
+            results[i] = (data, name, encode(new_mask) if new_mask is not None else None, timings)
+        except Exception as e:
+            results[i] = e
+    return results
+
+
+def run_batch(jobs, model=None, output=OUTPUT_MODE, load=0.0):
+    """remove_background_batch in a worker, along with the worker pid and
+    the CPU time the worker has used so far."""
+    results = remove_background_batch(jobs, model, output, load)
+    return results, os.getpid(), time.process_time()
+
+
+class InferenceExecutor:
+    """Runs the CPU bound segmentation in a pool of worker processes so the
+    event loop keeps receiving updates, pinging and uploading meanwhile."""
+
+    def __init__(self, workers=INFERENCE_WORKERS):
+        self.workers = workers
+        # pid -> CPU seconds that worker had used when it last returned
+        self.cpu_times = {}
+        # spawn instead of fork, the parent has a running event loop and threads
+        self.executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(workers,)
+        )
+
+    async def warm_up(self):
+        """Start the workers, each one warms up before taking jobs. Returns
+        the time it took and the report of every worker once all of them
+        are warm: the calls only return when one is running in every
+        worker, so a worker done early can't answer for a cold one."""
+        start = time.perf_counter()
+        with multiprocessing.get_context("spawn").Manager() as manager:
+            barrier = manager.Barrier(self.workers)
+            reports = await asyncio.gather(*[self.run(worker_report, barrier) for _ in range(self.workers)])
+        for report in reports:
+            self.cpu_times[report["pid"]] = report["cpu_time"]
+        return time.perf_counter() - start, reports
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def remove_background_batch(self, jobs, model=None, output=OUTPUT_MODE, load=0.0):
+        results, pid, cpu_time = await self.run(run_batch, jobs, model, output, load)
+        self.cpu_times[pid] = cpu_time
+        return results
+
+    def cpu_time(self):
+        """CPU seconds used by the workers, as of the last call each returned."""
+        return sum(self.cpu_times.values())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import os
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+QUEUE_DEPTH = int(os.environ.get("QUEUE_DEPTH", "64"))
+QUEUE_CONCURRENCY = int(os.environ.get("QUEUE_CONCURRENCY", "8"))
+QUEUE_DEADLINE = float(os.environ.get("QUEUE_DEADLINE", "60"))
+USER_JOBS = int(os.environ.get("USER_JOBS", "3"))
+# megapixels of job cost a waiting job makes up for every second it waits
+QUEUE_AGING = float(os.environ.get("QUEUE_AGING", "4"))
+
+# rough pixels per byte of a JPEG, for documents without known dimensions
+PIXELS_PER_BYTE = 8
+SIZE_CLASSES = [("small", 1_000_000), ("medium", 4_000_000), ("large", float("inf"))]
+
+
+class Busy(Exception):
+    pass
+
+
+def job_cost(media):
+    """Estimated cost of a photo or document in pixels."""
+    width, height = getattr(media, "width", 0), getattr(media, "height", 0)
+    if width and height:
+        return width * height
+    return (media.file_size or 0) * PIXELS_PER_BYTE
+
+
+def size_class(cost):
+    return next(name for name, limit in SIZE_CLASSES if cost < limit)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))] if values else 0.0
+
+
+class JobQueue:
+    """Admission control in front of the pipeline: at most `depth` jobs are
+    accepted at once, `per_user` of them for the same user, `concurrency` of
+    them run and the rest wait for up to `deadline` seconds.
+
+    Waiting jobs are served cheapest first. Every second of waiting counts as
+    `aging` megapixels less cost, so large jobs still get their turn.
+    """
+
+    def __init__(self, depth=QUEUE_DEPTH, concurrency=QUEUE_CONCURRENCY,
+                 deadline=QUEUE_DEADLINE, per_user=USER_JOBS, aging=QUEUE_AGING):
+        self.depth = depth
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.per_user = per_user
+        self.aging = aging * 1_000_000
+        self.running = 0
+        self.waiting = []
+        self.counter = itertools.count()
+        self.size = 0
+        self.users = defaultdict(int)
+        self.rejected = 0
+        self.expired = 0
+        self.waits = {name: deque(maxlen=1000) for name, _ in SIZE_CLASSES}
+
+    def admit(self, user_id):
+        if self.size >= self.depth or (user_id is not None and self.users[user_id] >= self.per_user):
+            self.rejected += 1
+            raise Busy()
+        self.size += 1
+        if user_id is not None:
+            self.users[user_id] += 1
+
+    def release(self, user_id):
+        self.size -= 1
+        if user_id is not None:
+            self.release_user(user_id)
+
+    def release_user(self, user_id):
+        self.users[user_id] -= 1
+        if not self.users[user_id]:
+            del self.users[user_id]
+
+    @contextmanager
+    def user(self, user_id):
+        """Count a group of jobs (an album) as a single job of the user, the
+        jobs themselves are then queued with user_id None."""
+        if self.users[user_id] >= self.per_user:
+            self.rejected += 1
+            raise Busy()
+        self.users[user_id] += 1
+        try:
+            yield
+        finally:
+            self.release_user(user_id)
+
+    async def acquire(self, cost):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+        else:
+            # aging as a static key: cost minus aging * wait orders the same as this
+            future = loop.create_future()
+            key = start + cost / self.aging
+            heapq.heappush(self.waiting, (key, next(self.counter), future))
+            try:
+                await asyncio.wait({future}, timeout=self.deadline)
+            except asyncio.CancelledError:
+                if future.done():
+                    # the slot was already handed over, pass it on
+                    self.next_job()
+                else:
+                    future.cancel()
+                raise
+            if not future.done():
+                future.cancel()
+                self.expired += 1
+                raise Busy()
+
+        waited = loop.time() - start
+        self.waits[size_class(cost)].append(waited)
+        return waited
+
+    def next_job(self):
+        # hand the slot over to the next waiting job, skipping expired ones
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def job(self, user_id, cost=0):
+        """Hold a slot for the duration of the job, yields the queue wait."""
+        self.admit(user_id)
+        try:
+            waited = await self.acquire(cost)
+            try:
+                yield waited
+            finally:
+                self.next_job()
+        finally:
+            self.release(user_id)
+
+    def stats(self):
+        return {
+            name: {
+                "p50": percentile(waits, 50),
+                "p95": percentile(waits, 95),
+                "p99": percentile(waits, 99),
+                "count": len(waits),
+            }
+            for name, waits in self.waits.items()
+        }
@@ -0,0 +1,208 @@
+"""Load tests the whole bot without Telegram: synthetic UpdateNewMessage
+updates carrying photos are pushed into the dispatcher queue at a fixed rate,
+downloads and uploads go to an in-memory media store, and the queue depths
+and reply latencies are printed as JSON.
+
+    python loadtest.py [--rates 10 100 1000] [--duration 10] [--reuse-masks]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import defaultdict, deque
+
+# the bot is imported with a fake account and without the on-disk caches
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "0" * 32)
+os.environ.setdefault("BOT_TOKEN", "0:loadtest")
+os.environ.setdefault("RESULT_CACHE_PATH", ":memory:")
+
+from pyrogram import raw, types
+
+from bench import SYNTHETIC_SIZES, synthetic_image
+from jobqueue import percentile
+
+BOT_ID = 1
+
+
+def user(user_id):
+    # Message._parse iterates the list fields, they can't be left out
+    if user_id == BOT_ID:
+        return raw.types.User(id=BOT_ID, access_hash=0, first_name="bot", bot=True, restriction_reason=[])
+    return raw.types.User(id=user_id, access_hash=0, first_name="loadtest", restriction_reason=[])
+
+
+class MediaStore:
+    """Stands in for Telegram: serves photo downloads from memory, keeps
+    uploads in memory and answers the send requests of the handler."""
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self):
+        self.files = {}
+        self.uploads = {}
+        self.ids = itertools.count(1)
+        self.sent = defaultdict(deque)
+        self.latencies = []
+        self.replies = 0
+        self.busy = 0
+
+    def add_photo(self, data, width, height):
+        photo_id = next(self.ids)
+        self.files[photo_id] = data
+        return raw.types.Photo(
+            id=photo_id, access_hash=0, file_reference=b"", date=int(time.time()), dc_id=1,
+            sizes=[raw.types.PhotoSize(type="y", w=width, h=height, size=len(data))]
+        )
+
+    def update(self, user_id, photo):
+        message = raw.types.Message(
+            # private chat: the peer is the sender, replies go back to it
+            id=next(self.ids), peer_id=raw.types.PeerUser(user_id=user_id),
+            from_id=raw.types.PeerUser(user_id=user_id), date=int(time.time()), message="",
+            media=raw.types.MessageMediaPhoto(photo=photo), entities=[]
+        )
+        users = {user_id: user(user_id), BOT_ID: user(BOT_ID)}
+        self.sent[user_id].append(time.perf_counter())
+        return raw.types.UpdateNewMessage(message=message, pts=0, pts_count=0), users, {}
+
+    async def get_file(self, file_id, file_size=0, limit=0, offset=0, progress=None, progress_args=()):
+        data = self.files[file_id.media_id]
+        for i in range(0, len(data), self.chunk_size):
+            await asyncio.sleep(0)
+            yield data[i:i + self.chunk_size]
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        file_id = next(self.ids)
+        self.uploads[file_id] = path.read()
+        return raw.types.InputFile(id=file_id, parts=1, name="file.png", md5_checksum="")
+
+    async def resolve_peer(self, peer_id):
+        return raw.types.InputPeerUser(user_id=peer_id, access_hash=0)
+
+    async def invoke(self, query, *args, **kwargs):
+        user_id = query.peer.user_id
+        if user_id in self.sent and self.sent[user_id]:
+            self.latencies.append(time.perf_counter() - self.sent[user_id].popleft())
+
+        media = None
+        if isinstance(query, raw.functions.messages.SendMedia):
+            self.replies += 1
+            data = self.uploads.pop(query.media.file.id)
+            photo = self.add_photo(data, 0, 0)
+            media = raw.types.MessageMediaPhoto(photo=photo)
+        else:
+            self.busy += 1
+
+        message = raw.types.Message(
+            id=next(self.ids), peer_id=raw.types.PeerUser(user_id=user_id),
+            from_id=raw.types.PeerUser(user_id=BOT_ID), date=int(time.time()), message="", out=True,
+            media=media, entities=[]
+        )
+        return raw.types.Updates(
+            updates=[raw.types.UpdateNewMessage(message=message, pts=0, pts_count=0)],
+            users=[user(user_id), user(BOT_ID)],
+            chats=[], date=int(time.time()), seq=0
+        )
+
+
+async def run_rate(bot, store, images, rate, duration, interval=0.1):
+    queue = bot.app.dispatcher.updates_queue
+    samples = defaultdict(list)
+    done = asyncio.Event()
+
+    async def sample():
+        while not done.is_set():
+            samples["dispatcher_queue"].append(queue.qsize())
+            samples["job_queue"].append(bot.jobs.size)
+            samples["jobs_waiting"].append(len(bot.jobs.waiting))
+            samples["batcher_pending"].append(sum(len(b) for b in bot.batcher.pending.values()))
+            samples["batches_running"].append(len(bot.batcher.tasks))
+            await asyncio.sleep(interval)
+
+    sampler = asyncio.create_task(sample())
+    store.latencies.clear()
+    store.replies = store.busy = 0
+    users = itertools.count(1000)
+    sent = 0
+    start = time.perf_counter()
+
+    # inject on schedule, catching up in bursts if the loop falls behind
+    while time.perf_counter() - start < duration:
+        due = int((time.perf_counter() - start) * rate) + 1
+        while sent < due:
+            data, width, height = images[sent % len(images)]
+            queue.put_nowait(store.update(next(users), store.add_photo(data, width, height)))
+            sent += 1
+        await asyncio.sleep(min(1 / rate, interval))
+
+    # let everything already injected finish
+    while store.replies + store.busy < sent and time.perf_counter() - start < duration + 120:
+        await asyncio.sleep(interval)
+    done.set()
+    await sampler
+
+    return {
+        "rate": rate,
+        "sent": sent,
+        "replied": store.replies,
+        "busy": store.busy,
+        "lost": sent - store.replies - store.busy,
+        "latency": {
+            "p50": percentile(store.latencies, 50),
+            "p95": percentile(store.latencies, 95),
+            "p99": percentile(store.latencies, 99),
+        },
+        "max_depth": {name: max(values, default=0) for name, values in samples.items()},
+        "mean_depth": {name: sum(values) / max(len(values), 1) for name, values in samples.items()},
+    }
+
+
+async def run(bot, rates, duration):
+    store = MediaStore()
+    app = bot.app
+    # filters.command reads the bot username
+    app.me = types.User(id=BOT_ID, is_bot=True, username="loadtest_bot", is_premium=False)
+    app.get_file = store.get_file
+    app.save_file = store.save_file
+    app.resolve_peer = store.resolve_peer
+    app.invoke = store.invoke
+
+    images = [(synthetic_image(w, h, seed=n), w, h) for n, (w, h) in enumerate(SYNTHETIC_SIZES)]
+    # start every worker before the first rate, like bot.main does
+    await bot.inference.warm_up()
+    await app.dispatcher.start()
+    try:
+        results = []
+        for rate in rates:
+            results.append(await run_rate(bot, store, images, rate, duration))
+            print(json.dumps(results[-1]), file=sys.stderr)
+        return results
+    finally:
+        await app.dispatcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", type=int, nargs="+", default=[10, 100, 1000], help="updates per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds every rate is sustained")
+    parser.add_argument("--reuse-masks", action="store_true", help="enable the perceptual hash mask reuse")
+    args = parser.parse_args()
+
+    import bot
+
+    bot.setup()
+    if not args.reuse_masks:
+        bot.masks.threshold = -1
+
+    # run on the client's loop, like app.run() does
+    results = bot.app.loop.run_until_complete(run(bot, args.rates, args.duration))
+    bot.inference.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+
+import numpy as np
+from PIL import Image
+from pymatting import estimate_alpha_cf, estimate_foreground_ml
+from scipy.ndimage import binary_erosion, find_objects, label
+
+# off: the mask is the alpha as is, full: closed-form matting over the whole
+# image (what rembg does), band: closed-form matting only around the mask edge,
+# pyramid: band matting at reduced size, guided upsampling and a full
+# resolution band solve only where the image has strong edges
+ALPHA_MATTING = os.environ.get("ALPHA_MATTING", "off")
+# same defaults as rembg
+MATTING_FOREGROUND_THRESHOLD = int(os.environ.get("MATTING_FOREGROUND_THRESHOLD", "240"))
+MATTING_BACKGROUND_THRESHOLD = int(os.environ.get("MATTING_BACKGROUND_THRESHOLD", "10"))
+MATTING_ERODE_SIZE = int(os.environ.get("MATTING_ERODE_SIZE", "10"))
+# the band is found in tiles of this size, neighbouring tiles are solved
+# together in regions of up to BAND_REGION pixels a side, each with a margin
+# of known pixels around it
+BAND_TILE = int(os.environ.get("BAND_TILE", "64"))
+BAND_REGION = int(os.environ.get("BAND_REGION", "256"))
+BAND_MARGIN = int(os.environ.get("BAND_MARGIN", "16"))
+# longest side the pyramid matting solves at
+PYRAMID_SIZE = int(os.environ.get("PYRAMID_SIZE", "640"))
+PYRAMID_RADIUS = int(os.environ.get("PYRAMID_RADIUS", "4"))
+PYRAMID_EPS = float(os.environ.get("PYRAMID_EPS", "1e-4"))
+# mean gradient (0-1 per pixel) above which a band tile is solved again at full
+# resolution, negative disables the refinement
+PYRAMID_REFINE_GRADIENT = float(os.environ.get("PYRAMID_REFINE_GRADIENT", "0.08"))
+
+UNKNOWN = 128
+
+
+def trimap(mask, foreground_threshold=MATTING_FOREGROUND_THRESHOLD,
+           background_threshold=MATTING_BACKGROUND_THRESHOLD, erode_size=MATTING_ERODE_SIZE):
+    """uint8 trimap of a mask: 255 sure foreground, 0 sure background,
+    UNKNOWN in between, like rembg builds it."""
+    structure = np.ones((erode_size, erode_size), dtype=bool)
+    is_foreground = binary_erosion(mask > foreground_threshold, structure=structure)
+    is_background = binary_erosion(mask < background_threshold, structure=structure, border_value=1)
+    result = np.full(mask.shape, UNKNOWN, dtype=np.uint8)
+    result[is_foreground] = 255
+    result[is_background] = 0
+    return result
+
+
+def matte_full(rgb, tri):
+    """Solve alpha and foreground over the whole image."""
+    image = rgb / 255.0
+    alpha = estimate_alpha_cf(image, tri / 255.0)
+    foreground = estimate_foreground_ml(image, alpha)
+    return np.clip(foreground * 255, 0, 255).astype(np.uint8), np.clip(alpha * 255, 0, 255).astype(np.uint8)
+
+
+def band_tiles(unknown, tile):
+    """Top left corners of the tiles that contain unknown pixels."""
+    height, width = unknown.shape
+    rows = -(-height // tile)
+    cols = -(-width // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=bool)
+    padded[:height, :width] = unknown
+    has_unknown = padded.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+    return [(y * tile, x * tile) for y, x in zip(*np.nonzero(has_unknown))]
+
+
+def band_regions(tiles, shape, tile, region):
+    """Merge the tiles into boxes (y0, x0, y1, x1): every group of touching
+    tiles is covered by its bounding box, cut into pieces of at most
+    `region` pixels a side so a long band isn't solved as one large box."""
+    height, width = shape
+    grid = np.zeros((-(-height // tile), -(-width // tile)), dtype=bool)
+    for y, x in tiles:
+        grid[y // tile, x // tile] = True
+    labels, _ = label(grid, structure=np.ones((3, 3)))
+    step = max(1, region // tile)
+    boxes = []
+    for n, (rows, cols) in enumerate(find_objects(labels), 1):
+        for r in range(rows.start, rows.stop, step):
+            for c in range(cols.start, cols.stop, step):
+                piece = labels[r:min(r + step, rows.stop), c:min(c + step, cols.stop)] == n
+                if not piece.any():
+                    continue
+                ys, xs = np.nonzero(piece)
+                boxes.append((
+                    (r + ys.min()) * tile, (c + xs.min()) * tile,
+                    min((r + ys.max() + 1) * tile, height), min((c + xs.max() + 1) * tile, width),
+                ))
+    return grid, boxes
+
+
+def matte_band(rgb, tri, mask, tile=BAND_TILE, margin=BAND_MARGIN, tiles=None, region=BAND_REGION):
+    """Solve alpha and foreground only in regions along the uncertain band of
+    the trimap, the sure regions are copied across. The cost follows the
+    length of the mask edge instead of the image area. `tiles` limits the
+    solve to some of the band tiles."""
+    height, width = tri.shape
+    unknown = tri == UNKNOWN
+    foreground = rgb.copy()
+    # outside the solved tiles (or where a region can't be solved) the mask is kept
+    alpha = np.where(unknown, mask, tri)
+
+    grid, boxes = band_regions(band_tiles(unknown, tile) if tiles is None else tiles, tri.shape, tile, region)
+    # the unknown pixels of the chosen tiles, the only ones written back
+    todo = unknown & np.kron(grid, np.ones((tile, tile), dtype=bool))[:height, :width]
+
+    for y, x, y_end, x_end in boxes:
+        y0, x0 = max(y - margin, 0), max(x - margin, 0)
+        y1, x1 = min(y_end + margin, height), min(x_end + margin, width)
+        crop = tri[y0:y1, x0:x1]
+        # closed-form matting needs both sure foreground and background around
+        if not (crop == 255).any() or not (crop == 0).any():
+            continue
+
+        image = rgb[y0:y1, x0:x1] / 255.0
+        region_alpha = estimate_alpha_cf(image, crop / 255.0)
+        region_foreground = estimate_foreground_ml(image, region_alpha)
+
+        core = np.s_[y - y0:y_end - y0, x - x0:x_end - x0]
+        target = np.s_[y:y_end, x:x_end]
+        where = todo[target]
+        alpha[target][where] = np.clip(region_alpha[core][where] * 255, 0, 255)
+        foreground[target][where] = np.clip(region_foreground[core][where] * 255, 0, 255)
+
+    return foreground, alpha
+
+
+def boxfilter(src, radius):
+    """Mean over a (2 * radius + 1) square window, with cumulative sums along
+    the rows and then the columns like pymatting's boxfilter helpers. The
+    window is clipped at the borders."""
+    def rows(a):
+        padded = np.pad(a, ((radius + 1, radius), (0, 0)), mode="constant")
+        cumsum = np.cumsum(padded, axis=0)
+        return cumsum[2 * radius + 1:] - cumsum[:-2 * radius - 1]
+
+    counts = rows(rows(np.ones(src.shape[:2])).T).T
+    return rows(rows(src).T).T / counts
+
+
+def guided_upsample(guide_small, alpha_small, guide, radius=PYRAMID_RADIUS, eps=PYRAMID_EPS):
+    """Fast guided filter: fit alpha = a * guide + b locally at low
+    resolution, then upsample only the a and b coefficients and apply them to
+    the full resolution guide, so alpha follows the full resolution edges."""
+    mean_i = boxfilter(guide_small, radius)
+    mean_p = boxfilter(alpha_small, radius)
+    cov_ip = boxfilter(guide_small * alpha_small, radius) - mean_i * mean_p
+    var_i = boxfilter(guide_small * guide_small, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    a = boxfilter(a, radius).astype(np.float32)
+    b = boxfilter(b, radius).astype(np.float32)
+
+    size = guide.shape[1], guide.shape[0]
+    a = np.asarray(Image.fromarray(a, "F").resize(size, Image.BILINEAR))
+    b = np.asarray(Image.fromarray(b, "F").resize(size, Image.BILINEAR))
+    return np.clip(a * guide + b, 0, 1)
+
+
+def gradient(gray):
+    gy, gx = np.gradient(gray)
+    return np.hypot(gx, gy)
+
+
+def matte_pyramid(rgb, mask, size=PYRAMID_SIZE, refine_gradient=PYRAMID_REFINE_GRADIENT):
+    """Band matting at reduced size, upsampled with a guided filter, then
+    solved again at full resolution only in the band tiles with strong
+    image edges (hair, fur) where the upsampled alpha is least reliable."""
+    height, width = mask.shape
+    scale = min(1.0, size / max(height, width))
+    small_size = max(1, round(width * scale)), max(1, round(height * scale))
+    rgb_small = np.asarray(Image.fromarray(rgb).resize(small_size, Image.BILINEAR))
+    mask_small = np.asarray(Image.fromarray(mask).resize(small_size, Image.BILINEAR))
+
+    erode_size = max(1, round(MATTING_ERODE_SIZE * scale))
+    _, alpha_small = matte_band(rgb_small, trimap(mask_small, erode_size=erode_size), mask_small)
+
+    gray = np.asarray(Image.fromarray(rgb).convert("L"), dtype=np.float32) / 255
+    gray_small = np.asarray(Image.fromarray(rgb_small).convert("L"), dtype=np.float32) / 255
+    alpha = guided_upsample(gray_small, alpha_small / 255.0, gray)
+    alpha = (alpha * 255).astype(np.uint8)
+    foreground = rgb
+
+    if refine_gradient >= 0:
+        tri = trimap(alpha)
+        grad = gradient(gray)
+        tiles = [
+            (y, x) for y, x in band_tiles(tri == UNKNOWN, BAND_TILE)
+            if grad[y:y + BAND_TILE, x:x + BAND_TILE].mean() > refine_gradient
+        ]
+        if tiles:
+            foreground, alpha = matte_band(rgb, tri, alpha, tiles=tiles)
+
+    return foreground, alpha
+
+
+def cutout(image, mask, mode=ALPHA_MATTING):
+    """RGBA cutout of the RGB image with alpha matting along the edge of the
+    mask, which must already be at the image resolution."""
+    rgb = np.asarray(image)
+    mask = np.asarray(mask)
+    if mode == "full":
+        foreground, alpha = matte_full(rgb, trimap(mask))
+    elif mode == "pyramid":
+        foreground, alpha = matte_pyramid(rgb, mask)
+    else:
+        foreground, alpha = matte_band(rgb, trimap(mask), mask)
+    rgba = np.dstack([foreground, alpha])
+    # nothing under alpha 0, as in composite
+    rgba[alpha == 0] = 0
+    return Image.fromarray(rgba, "RGBA")
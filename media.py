@@ -0,0 +1,28 @@
+from pyrogram.file_id import FileId
+
+
+async def download_to_buffer(client, media):
+    """Download a photo or document straight into a buffer preallocated from
+    its file_size, nothing is written to disk."""
+    buffer = bytearray(media.file_size or 0)
+    view = memoryview(buffer)
+    offset = 0
+    try:
+        async for chunk in client.get_file(FileId.decode(media.file_id), media.file_size):
+            end = offset + len(chunk)
+            if end > len(buffer):
+                # file_size was missing or wrong, grow the buffer
+                view.release()
+                buffer.extend(bytes(end - len(buffer)))
+                view = memoryview(buffer)
+            view[offset:end] = chunk
+            offset = end
+    finally:
+        view.release()
+
+    # get_file logs and stops on errors instead of raising
+    if offset == 0 or (media.file_size and offset < media.file_size):
+        raise IOError(f"Download of {media.file_unique_id} stopped after {offset} bytes")
+    if offset < len(buffer):
+        del buffer[offset:]
+    return buffer
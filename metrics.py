@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+RATIO_BUCKETS = (1, 1.5, 2, 3, 4, 6, 8, 12, 16, 32, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+class Metrics:
+    """Per stage latency histograms, other histograms and counters, served
+    in the Prometheus text format."""
+
+    def __init__(self):
+        self.histograms = {"stage_seconds": defaultdict(Histogram)}
+        self.gauges = {}
+        self.server = None
+
+    def histogram(self, name, buckets=BUCKETS):
+        """Register another histogram, filled with record()."""
+        self.histograms[name] = defaultdict(lambda: Histogram(buckets))
+
+    def record(self, name, value, **labels):
+        self.histograms[name][tuple(sorted(labels.items()))].observe(value)
+
+    def observe(self, stage, seconds, **labels):
+        self.histograms["stage_seconds"][(("stage", stage), *sorted(labels.items()))].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, func):
+        """Register a function returning the current value of a gauge, or a
+        dict of label value to gauge value."""
+        self.gauges[name] = func
+
+    def render(self):
+        lines = []
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append(f"# TYPE bot_{name} histogram")
+            for labels, histogram in sorted(histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'bot_{name}_bucket{{{format_labels((*labels, ("le", le)))}}} {count}')
+                lines.append(f"bot_{name}_sum{{{format_labels(labels)}}} {histogram.sum}")
+                lines.append(f"bot_{name}_count{{{format_labels(labels)}}} {histogram.count}")
+
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE bot_{name} gauge")
+            value = func()
+            if isinstance(value, dict):
+                for key, v in sorted(value.items()):
+                    lines.append(f'bot_{name}{{key="{key}"}} {v}')
+            else:
+                lines.append(f"bot_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, reader, writer):
+        try:
+            # the request itself doesn't matter, every path returns the metrics
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def stop_server(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,77 @@
+import io
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+# maximum differing bits out of 64 for two images to be compared at all
+PHASH_THRESHOLD = int(os.environ.get("PHASH_THRESHOLD", "2"))
+# maximum mean absolute difference (0-255) of their 16x16 grayscale
+# thumbnails for the mask to be reused, the hash alone matches different
+# pictures with a similar layout
+PHASH_MAX_DIFF = float(os.environ.get("PHASH_MAX_DIFF", "3"))
+PHASH_INDEX_SIZE = int(os.environ.get("PHASH_INDEX_SIZE", "10000"))
+THUMB_SIZE = 16
+
+
+def dhash(image_bytes):
+    """64 bit difference hash of the image, its aspect ratio and a small
+    grayscale thumbnail to confirm matches with."""
+    image = Image.open(io.BytesIO(image_bytes))
+    aspect = image.width / image.height
+    # a tiny decode is all the hash needs
+    image.draft("L", (64, 64))
+    image = image.convert("L")
+    px = np.asarray(image.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    thumb = np.asarray(image.resize((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR), dtype=np.uint8)
+    return int(np.packbits(bits).view(">u8")[0]), aspect, thumb
+
+
+class HashIndex:
+    """Ring buffer of image hashes with the low resolution mask computed for
+    them, looked up by Hamming distance."""
+
+    def __init__(self, capacity=PHASH_INDEX_SIZE, threshold=PHASH_THRESHOLD, max_diff=PHASH_MAX_DIFF):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.max_diff = max_diff
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.aspects = np.zeros(capacity, dtype=np.float32)
+        self.thumbs = np.zeros((capacity, THUMB_SIZE, THUMB_SIZE), dtype=np.uint8)
+        self.masks = [None] * capacity
+        self.next = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        value, aspect, thumb = key
+        with self.lock:
+            count = min(self.next, self.capacity)
+            if count:
+                xor = np.bitwise_xor(self.hashes[:count], np.uint64(value))
+                distances = np.unpackbits(xor.view(np.uint8).reshape(count, 8), axis=1).sum(axis=1)
+                # a resized copy keeps its aspect ratio, a crop doesn't
+                distances[np.abs(self.aspects[:count] - aspect) > 0.01 * aspect] = 64
+                candidates = np.flatnonzero(distances <= self.threshold)
+                if len(candidates):
+                    # confirm with the thumbnails, the closest one wins
+                    diffs = np.abs(self.thumbs[candidates].astype(np.int16) - thumb).mean(axis=(1, 2))
+                    best = int(diffs.argmin())
+                    if diffs[best] <= self.max_diff:
+                        self.hits += 1
+                        return self.masks[candidates[best]]
+            self.misses += 1
+            return None
+
+    def add(self, key, mask):
+        value, aspect, thumb = key
+        with self.lock:
+            slot = self.next % self.capacity
+            self.hashes[slot] = value
+            self.aspects[slot] = aspect
+            self.thumbs[slot] = thumb
+            self.masks[slot] = mask
+            self.next += 1
@@ -0,0 +1,49 @@
+import os
+import queue
+from contextlib import contextmanager
+
+import onnxruntime as ort
+from rembg import new_session
+
+# comma separated list of rembg models to load at startup, the first one is the default
+MODELS = [m.strip() for m in os.environ.get("MODELS", "u2net").split(",") if m.strip()]
+SESSION_POOL_SIZE = int(os.environ.get("SESSION_POOL_SIZE", "1"))
+
+
+def session_options(threads=0):
+    """ONNX Runtime options running a model on `threads` cores, by default
+    every session starts a thread per core and the workers fight over them."""
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1 if threads else 0
+    return options
+
+
+class SessionPool:
+    """Keeps a bounded number of ready rembg sessions per model so the
+    ONNX model is loaded once instead of on every photo. Every inference
+    worker has its own pool and runs one batch at a time."""
+
+    def __init__(self, models=None, size=SESSION_POOL_SIZE, threads=0):
+        self.models = models or MODELS
+        self.size = size
+        self.pools = {}
+
+        for model in self.models:
+            pool = queue.Queue(size)
+            for _ in range(size):
+                pool.put(new_session(model, sess_opts=session_options(threads)))
+            self.pools[model] = pool
+
+    @property
+    def default_model(self):
+        return self.models[0]
+
+    @contextmanager
+    def session(self, model=None):
+        pool = self.pools[model or self.default_model]
+        session = pool.get()
+        try:
+            yield session
+        finally:
+            pool.put(session)